@@ -2,11 +2,12 @@ import unittest
 
 import numpy as np
 from graphix.random_objects import rand_circuit
+from graphix.sim.density_matrix import DensityMatrixBackend
 from graphix.sim.statevec import StatevectorBackend
 from graphix.states import BasicStates
 from numpy.random import Generator
 
-from veriphix.client import Client, ClientMeasureMethod, Secrets
+from veriphix.client import Client, ClientMeasureMethod, Secret_a, SecretDatas, Secrets
 
 
 class TestClient:
@@ -29,6 +30,55 @@ class TestClient:
         # Assert something...
         # Todo ?
 
+    def test_a_N_secret(self, fx_rng: Generator):
+        nqubits = 2
+        depth = 2
+        circuit = rand_circuit(nqubits, depth, fx_rng)
+        pattern = circuit.transpile().pattern
+        pattern.standardize(method="global")
+        nodes, edges = pattern.get_graph()
+
+        client = Client(pattern=pattern, secrets=Secrets(a=True))
+
+        a = client.secret_datas.a.a
+        for node in pattern.input_nodes:
+            assert a[node] == 0
+        for node in nodes:
+            neighbors = {v for u, v in edges if u == node} | {u for u, v in edges if v == node}
+            assert client.secret_datas.a.a_N[node] == sum(a[neighbor] for neighbor in neighbors) % 2
+
+    def test_secrets_rng(self, fx_rng: Generator):
+        nqubits = 2
+        depth = 1
+        circuit = rand_circuit(nqubits, depth, fx_rng)
+        pattern = circuit.transpile().pattern
+        pattern.standardize(method="global")
+        secrets = Secrets(a=True, r=True, theta=True)
+
+        client_1 = Client(pattern=pattern, secrets=secrets, rng=np.random.default_rng(42))
+        client_2 = Client(pattern=pattern, secrets=secrets, rng=np.random.default_rng(42))
+        assert client_1.secret_datas == client_2.secret_datas
+
+        client_1.refresh_randomness()
+        client_2.refresh_randomness()
+        assert client_1.secret_datas == client_2.secret_datas
+
+    def test_pauli_preprocessed_pattern(self, fx_rng: Generator):
+        nqubits = 3
+        depth = 8
+        circuit = rand_circuit(nqubits, depth, fx_rng)
+        pattern = circuit.transpile().pattern
+        pattern.standardize(method="global")
+        pattern.shift_signals()
+        pattern.perform_pauli_measurements()
+        secrets = Secrets(a=True, r=True, theta=True)
+
+        # The remaining node ids are not contiguous
+        client = Client(pattern=pattern, secrets=secrets)
+        backend = StatevectorBackend()
+        client.delegate_pattern(backend)
+        assert set(backend.node_index) == set(pattern.output_nodes)
+
     def test_r_secret_simulation(self, fx_rng: Generator):
         # Generate and standardize pattern
         nqubits = 2
@@ -155,6 +205,48 @@ class TestClient:
         client.blind_qubits(backend)
         assert set(backend.node_index) == set(nodes)
 
+    def test_blind_statevector(self, fx_rng: Generator):
+        nqubits = 2
+        depth = 1
+        circuit = rand_circuit(nqubits, depth, fx_rng)
+        pattern = circuit.transpile().pattern
+        pattern.standardize(method="global")
+        secrets = Secrets(a=True, r=True, theta=True)
+        client = Client(pattern=pattern, secrets=secrets)
+
+        # Fused blinding on the state vector
+        sv_backend = StatevectorBackend()
+        client.prepare_states(sv_backend)
+        client.blind_qubits(sv_backend)
+        # Qubit-by-qubit blinding on the density matrix
+        dm_backend = DensityMatrixBackend()
+        client.prepare_states(dm_backend)
+        client.blind_qubits(dm_backend)
+
+        psi = sv_backend.state.psi.flatten()
+        np.testing.assert_almost_equal(dm_backend.state.rho, np.outer(psi, psi.conj()))
+
+    def test_replaced_secret_datas(self, fx_rng: Generator):
+        nqubits = 2
+        depth = 1
+        circuit = rand_circuit(nqubits, depth, fx_rng)
+        pattern = circuit.transpile().pattern
+        pattern.standardize(method="global")
+        secrets = Secrets(a=True, r=True, theta=True)
+        client = Client(pattern=pattern, secrets=secrets)
+
+        # Blinding, measuring and decoding must all use the new secrets
+        nodes = client.nodes_list
+        zeros = {node: 0 for node in nodes}
+        client.secret_datas = SecretDatas(r=dict(zeros), a=Secret_a(a=dict(zeros), a_N=dict(zeros)), theta=dict(zeros))
+
+        backend = StatevectorBackend()
+        client.delegate_pattern(backend)
+        clear_simulation = circuit.simulate_statevector().statevec
+        np.testing.assert_almost_equal(
+            np.abs(np.dot(backend.state.psi.flatten().conjugate(), clear_simulation.psi.flatten())), 1
+        )
+
     def test_UBQC(self, fx_rng: Generator):
         # Generate random pattern
         nqubits = 2
@@ -0,0 +1,98 @@
+import random
+
+import networkx as nx
+import numpy as np
+import pytest
+import stim
+from numpy.random import Generator
+
+from veriphix.trappifiedCanvas import TrappifiedCanvas, pack_paulis, to_pauli_string, unpack_paulis
+
+
+class TestTrappifiedCanvas:
+    @pytest.mark.parametrize("n_qubits", [1, 63, 64, 65, 130])
+    def test_pack_paulis(self, fx_rng: Generator, n_qubits: int):
+        xs = fx_rng.integers(0, 2, size=n_qubits).astype(bool)
+        zs = fx_rng.integers(0, 2, size=n_qubits).astype(bool)
+        expected = stim.PauliString.from_numpy(xs=xs, zs=zs)
+
+        packed = pack_paulis(n_qubits, np.flatnonzero(xs), np.flatnonzero(zs))
+
+        assert list(unpack_paulis(packed, n_qubits)) == list(expected)
+        assert to_pauli_string(packed, n_qubits) == expected
+
+    def test_canonical_stabilizer(self):
+        graph = nx.path_graph(3)
+        canvas = TrappifiedCanvas(graph, traps_list=[{0}, {2}])
+
+        assert to_pauli_string(canvas.get_canonical_stabilizer(1), 3) == stim.PauliString("ZXZ")
+        assert to_pauli_string(canvas.stabilizer, 3) == stim.PauliString("XZX")
+
+    def test_common_eigenstate(self):
+        graph = nx.path_graph(3)
+        canvas = TrappifiedCanvas(graph, traps_list=[{0}])
+
+        # Adjacent single-qubit traps act with different Paulis on the same qubits
+        assert not canvas.common_eigenstate(canvas.get_canonical_stabilizer(0), canvas.get_canonical_stabilizer(1))
+        assert canvas.common_eigenstate(canvas.get_canonical_stabilizer(0), canvas.get_canonical_stabilizer(2))
+
+    def test_merge_pauli_list_incompatible(self):
+        graph = nx.path_graph(4)
+        canvas = TrappifiedCanvas(graph, traps_list=[{0}, {1}, {3}])
+
+        # {1} cannot be merged with {0}, which absorbs {3}
+        assert to_pauli_string(canvas.stabilizer, 4) == stim.PauliString("XZZX")
+
+    def test_presorted(self):
+        graph = nx.cycle_graph(6)
+        traps_list = [{0}, {2}, {4}]
+        canvas = TrappifiedCanvas(graph, traps_list=traps_list)
+        presorted_canvas = TrappifiedCanvas(graph, traps_list=traps_list, presorted=True)
+
+        assert np.array_equal(canvas.stabilizer, presorted_canvas.stabilizer)
+
+    def test_presorted_incompatible(self):
+        graph = nx.path_graph(3)
+
+        with pytest.raises(ValueError):
+            TrappifiedCanvas(graph, traps_list=[{0}, {1}], presorted=True)
+
+    def test_single_qubit_traps(self):
+        graph = nx.cycle_graph(6)
+        canvas = TrappifiedCanvas(graph, traps_list=[{0}, {3}])
+        int_canvas = TrappifiedCanvas(graph, traps_list=[0, 3])
+
+        assert int_canvas.single_qubit_traps
+        assert int_canvas.trap_qubits == canvas.trap_qubits
+        assert sorted(int_canvas.dummy_qubits) == sorted(canvas.dummy_qubits)
+        assert np.array_equal(int_canvas.stabilizer, canvas.stabilizer)
+
+    def test_traps_set(self):
+        graph = nx.cycle_graph(6)
+        canvas = TrappifiedCanvas(graph, traps_list={0, 3})
+
+        assert canvas.traps_list == [0, 3]
+        assert np.array_equal(canvas.stabilizer, TrappifiedCanvas(graph, traps_list=[0, 3]).stabilizer)
+
+    def test_non_contiguous_nodes(self):
+        graph = nx.cycle_graph(6)
+        relabeled_graph = nx.relabel_nodes(graph, {node: 7 * node + 2 for node in graph.nodes})
+
+        random.seed(0)
+        canvas = TrappifiedCanvas(graph, traps_list=[0, 3])
+        random.seed(0)
+        relabeled_canvas = TrappifiedCanvas(relabeled_graph, traps_list=[2, 23])
+
+        assert np.array_equal(relabeled_canvas.stabilizer, canvas.stabilizer)
+        assert np.array_equal(relabeled_canvas.coins, canvas.coins)
+        assert relabeled_canvas.states == canvas.states
+
+    def test_weighted_graph(self):
+        graph = nx.path_graph(3)
+        nx.set_edge_attributes(graph, 2, "weight")
+
+        random.seed(4)
+        canvas = TrappifiedCanvas(graph, traps_list=[1])
+
+        # The coin of the trap qubit is the parity of the coins of its neighbors, whatever the weights
+        assert canvas.coins[1] == canvas.coins[0] ^ canvas.coins[2]
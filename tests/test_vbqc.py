@@ -1,5 +1,6 @@
 import graphix.command
 import numpy as np
+import pytest
 from graphix.noise_models import DepolarisingNoiseModel
 from graphix.random_objects import Circuit, rand_circuit
 from graphix.sim.density_matrix import DensityMatrixBackend
@@ -56,6 +57,24 @@ class TestVBQC:
             trap_outcomes = client.delegate_test_run(backend=backend, run=run, noise_model=noise_model)
             assert sum(trap_outcomes) == 0
 
+    def test_unmeasured_output_trap(self):
+        circuit = Circuit(3)
+        circuit.rz(1, np.pi / 4)
+        circuit.cnot(0, 2)
+        pattern = circuit.transpile().pattern
+        pattern.standardize()
+        # The output nodes are not measured: their traps cannot be checked
+
+        states = [BasicStates.PLUS for _ in pattern.input_nodes]
+        secrets = Secrets(a=True, r=True, theta=True)
+        client = Client(pattern=pattern, input_state=states, secrets=secrets)
+        output_nodes = set(pattern.output_nodes)
+        for run in client.create_test_runs():
+            if output_nodes.isdisjoint(run.trap_qubits):
+                continue
+            with pytest.raises(KeyError):
+                client.delegate_test_run(backend=StatevectorBackend(), run=run)
+
     def test_noisy(self):
         circuit = Circuit(3)
         circuit.rz(1, np.pi / 4)
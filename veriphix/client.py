@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import functools
+import operator
 from dataclasses import dataclass
 from typing import TYPE_CHECKING
 
@@ -12,6 +14,7 @@ import graphix.sim.statevec
 import graphix.simulator
 import networkx as nx
 import numpy as np
+import scipy.sparse
 from graphix.clifford import Clifford
 from graphix.command import BaseM, CommandKind, MeasureUpdate
 from graphix.measurements import Measurement
@@ -22,12 +25,13 @@ from graphix.sim.statevec import StatevectorBackend
 from graphix.simulator import MeasureMethod, PatternSimulator
 from graphix.states import BasicStates
 
-from veriphix.trappifiedCanvas import TrappifiedCanvas
+from veriphix.trappifiedCanvas import TrappifiedCanvas, build_canonical_stabilizers, trap_nodes
 
 if TYPE_CHECKING:
     from graphix.sim.base_backend import Backend
+    from numpy.random import Generator
 
-    from veriphix.trappifiedCanvas import Trap
+    from veriphix.trappifiedCanvas import PackedPauli, Trap
 
 
 # TODO update docstring
@@ -43,6 +47,13 @@ simulator.run()
 """
 
 
+# exp(i k pi/4) for k in 0..7
+PHASES_PI_4 = np.exp(1j * np.pi / 4 * np.arange(8))
+
+# Entry of the dense results for a node that has not been measured
+UNMEASURED = -1
+
+
 @dataclass
 class TrappifiedRun:
     input_state: list
@@ -71,40 +82,79 @@ class SecretDatas:
 
     # NOTE: not a class method?
     @staticmethod
-    def from_secrets(secrets: Secrets, graph, input_nodes, output_nodes):
+    def from_secrets(
+        secrets: Secrets,
+        graph,
+        input_nodes,
+        output_nodes,
+        adjacency=None,
+        rng: int | Generator | None = None,
+    ):
         node_list, edge_list = graph
+        n_nodes = len(node_list)
+        rng = np.random.default_rng(rng)
         r = {}
         if secrets.r:
             # Need to generate the random bit for each measured qubit, 0 for the rest (output qubits)
-            for node in node_list:
-                r[node] = np.random.randint(0, 2) if node not in output_nodes else 0
+            r_arr = rng.integers(0, 2, size=n_nodes, dtype=np.int8)
+            r_arr[node_mask(node_list, output_nodes)] = 0
+            r = node_dict(node_list, r_arr)
 
         theta = {}
         if secrets.theta:
             # Create theta secret for all non-output nodes (measured qubits)
-            for node in node_list:
-                theta[node] = np.random.randint(0, 8) if node not in output_nodes else 0  # Expressed in pi/4 units
-                ## TODO:
+            theta_arr = rng.integers(0, 8, size=n_nodes, dtype=np.int8)  # Expressed in pi/4 units
+            theta_arr[node_mask(node_list, output_nodes)] = 0
+            theta = node_dict(node_list, theta_arr)
+            ## TODO:
         a = {}
         a_N = {}
         if secrets.a:
             # Create `a` secret for all
             # order is Z(theta) X |+>
-            for node in node_list:
-                a[node] = np.random.randint(0, 2) if node not in input_nodes else 0
+            a_arr = rng.integers(0, 2, size=n_nodes, dtype=np.uint8)
+            a_arr[node_mask(node_list, input_nodes)] = 0
 
             # After all the `a` secrets have been generated, the `a_N` value can be
-            # computed from the graph topology
-            for i in node_list:
-                a_N_value = 0
-                for j in node_list:
-                    if (i, j) in edge_list or (j, i) in edge_list:
-                        a_N_value ^= a[j]
-                a_N[i] = a_N_value
+            # computed from the graph topology: a_N[i] is the parity of `a` over the neighbors of i
+            if adjacency is None:
+                adjacency = adjacency_matrix(node_list, edge_list)
+            a_N_arr = (adjacency @ a_arr) & 1
+            a = node_dict(node_list, a_arr)
+            a_N = node_dict(node_list, a_N_arr)
 
         return SecretDatas(r, Secret_a(a, a_N), theta)
 
 
+def node_dict(node_list, values: np.ndarray) -> dict[int, int]:
+    """Map each node of `node_list` to the entry of `values` at the same position."""
+    values = values.tolist()
+    return {node: values[i] for i, node in enumerate(node_list)}
+
+
+def node_mask(node_list, selected_nodes) -> np.ndarray:
+    """Boolean mask over `node_list` flagging the nodes in `selected_nodes`."""
+    selected_nodes = set(selected_nodes)
+    return np.fromiter((node in selected_nodes for node in node_list), dtype=bool, count=len(node_list))
+
+
+def adjacency_matrix(node_list, edge_list) -> scipy.sparse.csr_matrix:
+    """
+    Symmetric adjacency matrix of the graph, with rows and columns ordered as `node_list`.
+
+    Entries are `uint8` so that products with bit vectors stay in `uint8`: wrap-around preserves parity.
+    """
+    node_index = {node: i for i, node in enumerate(node_list)}
+    rows = [node_index[u] for u, _ in edge_list]
+    cols = [node_index[v] for _, v in edge_list]
+    data = np.ones(2 * len(edge_list), dtype=np.uint8)
+    n_nodes = len(node_list)
+    adjacency = scipy.sparse.csr_matrix((data, (rows + cols, cols + rows)), shape=(n_nodes, n_nodes))
+    # Edges listed twice are summed during the conversion: keep a 0/1 matrix
+    adjacency.data[:] = 1
+    return adjacency
+
+
 @dataclass
 class ByProduct:
     z_domain: list[int]
@@ -125,6 +175,28 @@ def get_byproduct_db(pattern: Pattern) -> dict[int, ByProduct]:
     return byproduct_db
 
 
+def dense_results(nodes, results: dict[int, int]) -> np.ndarray:
+    """
+    Returns the measurement outcomes as an array indexed by node, filled with `results` and `UNMEASURED` elsewhere.
+    """
+    dense = np.full(max([*nodes, *results], default=-1) + 1, UNMEASURED, dtype=np.int8)
+    dense[list(results)] = list(results.values())
+    return dense
+
+
+def domain_idx(domain) -> np.ndarray:
+    return np.fromiter(domain, dtype=np.intp, count=len(domain))
+
+
+def get_signal_idx(measurement_db: dict[int, BaseM]) -> dict[int, tuple[np.ndarray, np.ndarray]]:
+    """
+    Returns the s- and t-domains of each measurement as index arrays into the dense results.
+    """
+    return {
+        node: (domain_idx(measure.s_domain), domain_idx(measure.t_domain)) for node, measure in measurement_db.items()
+    }
+
+
 def remove_flow(pattern):
     clean_pattern = Pattern(pattern.input_nodes)
     for cmd in pattern:
@@ -154,22 +226,48 @@ def prepared_nodes_as_input_nodes(pattern: Pattern) -> Pattern:
 
 
 class Client:
-    def __init__(self, pattern, input_state=None, measure_method_cls=None, secrets: None | Secrets = None) -> None:
+    def __init__(
+        self,
+        pattern,
+        input_state=None,
+        measure_method_cls=None,
+        secrets: None | Secrets = None,
+        rng: int | Generator | None = None,
+    ) -> None:
         self.initial_pattern = pattern
+        # Random generator of the secrets, reused at every refresh
+        self._rng = np.random.default_rng(rng)
 
         self.input_nodes = self.initial_pattern.input_nodes.copy()
         self.output_nodes = self.initial_pattern.output_nodes.copy()
         self.graph = self.initial_pattern.get_graph()
         self.nodes_list = self.graph[0]
+        self._sorted_nodes = sorted(self.nodes_list)
+        # Shared by the test runs: the graph is fixed for the lifetime of the client
+        self._nx_graph = nx.Graph()
+        self._nx_graph.add_edges_from(self.graph[1])
+        self._nx_graph.add_nodes_from(self.nodes_list)
+        # Rows and columns follow `self._sorted_nodes`; built once since the graph is fixed
+        self._adjacency = adjacency_matrix(self._sorted_nodes, self.graph[1])
 
         # Copy the pauli-preprocessed nodes' measurement outcomes
-        self.results = pattern.results.copy()
+        self._pauli_results = dense_results(self.nodes_list, pattern.results)
+        self.results = self._pauli_results.copy()
         if measure_method_cls is None:
             measure_method_cls = ClientMeasureMethod
         self.measure_method = measure_method_cls(self)
 
         self.measurement_db = {measure.node: measure for measure in pattern.get_measurement_commands()}
+        self._signal_idx = get_signal_idx(self.measurement_db)
+        # X-basis measurements without signals, used by the test runs
+        self._xbasis_measurement_db = {node: graphix.command.M(node=node) for node in self.measurement_db}
+        self._xbasis_signal_idx = get_signal_idx(self._xbasis_measurement_db)
         self.byproduct_db = get_byproduct_db(pattern)
+        # Both domains of each output node in one index array, z-domain first, with the z-domain length
+        self._zx_idx = {
+            node: (domain_idx([*byproduct.z_domain, *byproduct.x_domain]), len(byproduct.z_domain))
+            for node, byproduct in self.byproduct_db.items()
+        }
         # print("byprod_db", self.byproduct_db)
 
         # self.secrets_bool : bool -> self.secrets is not None
@@ -180,7 +278,14 @@ class Client:
             self.secrets_bool = False
             secrets = Secrets()
 
-        self.secret_datas = SecretDatas.from_secrets(secrets, self.graph, self.input_nodes, self.output_nodes)
+        self.secret_datas = SecretDatas.from_secrets(
+            secrets,
+            (self._sorted_nodes, self.graph[1]),
+            self.input_nodes,
+            self.output_nodes,
+            adjacency=self._adjacency,
+            rng=self._rng,
+        )
 
         pattern_without_flow = remove_flow(pattern)
         self.clean_pattern = prepared_nodes_as_input_nodes(pattern_without_flow)
@@ -192,22 +297,60 @@ class Client:
 
         # refresh only if secrets bool is True; False is no randomness at all.
         if self.secrets is not None:
-            self.secret_datas = SecretDatas.from_secrets(self.secrets, self.graph, self.input_nodes, self.output_nodes)
+            self.secret_datas = SecretDatas.from_secrets(
+                self.secrets,
+                (self._sorted_nodes, self.graph[1]),
+                self.input_nodes,
+                self.output_nodes,
+                adjacency=self._adjacency,
+                rng=self._rng,
+            )
+
+    def _blinded_nodes(self) -> tuple[list[int], list[tuple[int, int]]]:
+        """
+        Returns the nodes with a non-trivial `a` secret, and the nodes with their non-trivial `theta` secret:
+        only those need to be blinded. They are read from the current `secret_datas`.
+        """
+        a_nodes = [node for node, a in self.secret_datas.a.a.items() if a]
+        theta_nodes = [(node, theta) for node, theta in self.secret_datas.theta.items() if theta]
+        return a_nodes, theta_nodes
 
     def blind_qubits(self, backend: Backend) -> None:
+        if isinstance(backend, StatevectorBackend):
+            self.blind_statevector(backend)
+            return
+
         def z_rotation(theta) -> np.array:
             return np.array([[1, 0], [0, np.exp(1j * theta * np.pi / 4)]])
 
-        def x_blind(a) -> Pauli:
-            return Pauli.X if (a == 1) else Pauli.I
+        # order is Z(theta) X on each node
+        a_nodes, theta_nodes = self._blinded_nodes()
+        for node in a_nodes:
+            backend.apply_single(node=node, op=Pauli.X.matrix)
+        for node, theta in theta_nodes:
+            backend.apply_single(node=node, op=z_rotation(theta))
 
-        for node in self.nodes_list:
-            theta = self.secret_datas.theta.get(node, 0)
-            a = self.secret_datas.a.a.get(node, 0)
-            if a:
-                backend.apply_single(node=node, op=x_blind(a).matrix)
-            if theta:
-                backend.apply_single(node=node, op=z_rotation(theta))
+    def blind_statevector(self, backend: StatevectorBackend) -> None:
+        """
+        Same as `blind_qubits`, with all the single-qubit blinding operators applied in one pass:
+        the X's permute the amplitudes (flip along the qubit axes), then the Z(theta)'s multiply them by a diagonal phase.
+        """
+        a_nodes, theta_nodes = self._blinded_nodes()
+        if not a_nodes and not theta_nodes:
+            return
+        qubit_index = {node: i for i, node in enumerate(backend.node_index)}
+        psi = backend.state.psi
+        if a_nodes:
+            psi = np.flip(psi, axis=[qubit_index[node] for node in a_nodes])
+        if theta_nodes:
+            # Phase of each amplitude in pi/4 units, broadcast along the qubit axes
+            phase = np.zeros((1,) * psi.ndim, dtype=np.uint8)
+            for node, theta in theta_nodes:
+                shape = [1] * psi.ndim
+                shape[qubit_index[node]] = 2
+                phase = phase + np.array([0, theta], dtype=np.uint8).reshape(shape)
+            psi = psi * PHASES_PI_4[phase % 8]
+        backend.state.psi = np.ascontiguousarray(psi)
 
     def prepare_states(self, backend: Backend) -> None:
         # First prepare inputs
@@ -229,6 +372,28 @@ class Client:
             output_data.append(BasicStates.PLUS if r_value ^ a_N_value == 0 else BasicStates.MINUS)
         backend.add_nodes(nodes=self.output_nodes, data=output_data)
 
+    @functools.cached_property
+    def _canonical_stabilizers(self) -> dict[int, PackedPauli]:
+        """
+        Canonical stabilizers of the graph, shared by all the trappified canvases of the test runs.
+        Only the test runs need them, hence they are built on first use.
+        """
+        return build_canonical_stabilizers(self._sorted_nodes, self.graph[1])
+
+    @functools.cached_property
+    def _coloring(self) -> dict[int, list[int]]:
+        """
+        Greedy coloring of the graph, as the sorted list of nodes of each color.
+        It only depends on the graph, hence is computed once.
+        """
+        coloring = nx.coloring.greedy_color(self._nx_graph, strategy="largest_first")
+        colors = set(coloring.values())
+        nodes_by_color = {c: [] for c in colors}
+        for node in self._sorted_nodes:
+            color = coloring[node]
+            nodes_by_color[color].append(node)
+        return nodes_by_color
+
     def create_test_runs(self) -> list[TrappifiedCanvas]:
         """
         Creates test runs according to FK12 protocol of
@@ -241,73 +406,86 @@ class Client:
         For a color, single-qubit traps are created for each node of that color.
         """
 
-        # TODO: just pattern.get_graph()
-        graph = nx.Graph()
-        nodes, edges = self.graph
-        graph.add_edges_from(edges)
-        graph.add_nodes_from(nodes)
-
-        # Create the graph coloring
-        coloring = nx.coloring.greedy_color(graph, strategy="largest_first")
-        colors = set(coloring.values())
-        nodes_by_color = {c: [] for c in colors}
-        for node in sorted(graph.nodes):
-            color = coloring[node]
-            nodes_by_color[color].append(node)
+        nodes_by_color = self._coloring
 
         # Create the test runs : one per color
         runs: list[TrappifiedCanvas] = []
-        for color in colors:
+        for color in nodes_by_color:
             # 1 color = 1 test run = 1 set of traps
-            traps_list = []
-            for colored_node in nodes_by_color[color]:
-                trap_qubits = [colored_node]  # single-qubit trap
-                trap: Trap = set(trap_qubits)
-                traps_list.append(trap)
-
-            ## TODO
-            # In here, traps_list is a list of traps that are compatible already, because they are of the same color
-            # So we can just merge them all already
-            # And assume that TrappifiedCanvas needs to be instanciated with a traps_list that corresponds to a coloring.
-            # and TC just merges them assuming they are all mergeable.
-            trappified_canvas = TrappifiedCanvas(graph, traps_list=traps_list)
+            # single-qubit traps, given as bare nodes
+            traps_list: list[Trap] = list(nodes_by_color[color])
+
+            # Traps of the same color are not adjacent, hence compatible: they can be merged in a single pass
+            trappified_canvas = TrappifiedCanvas(
+                self._nx_graph,
+                traps_list=traps_list,
+                canonical_stabilizers=self._canonical_stabilizers,
+                adjacency=self._adjacency,
+                presorted=True,
+            )
 
             runs.append(trappified_canvas)
         return runs
 
+    def reset_results(self) -> None:
+        """Forget the outcomes of the previous run, keeping those of the pauli-preprocessed nodes."""
+        self.results = self._pauli_results.copy()
+
+    def get_results(self, idx) -> np.ndarray:
+        """
+        Returns the outcomes of the nodes in `idx`.
+        Raises `KeyError` if one of them has not been measured.
+        """
+        outcomes = self.results[idx]
+        unmeasured = outcomes == UNMEASURED
+        if unmeasured.any():
+            raise KeyError(int(np.asarray(idx)[unmeasured][0]))
+        return outcomes
+
     def delegate_test_run(self, backend: Backend, run: TrappifiedCanvas, **kwargs) -> list[int]:
+        self.reset_results()
         # The state is entirely prepared and blinded by the client before being sent to the server
-        # StateVectorBackend because noiseless preparation
-        preparation_backend = StatevectorBackend()
-        preparation_backend.add_nodes(nodes=sorted(self.graph[0]), data=run.states)
-        self.blind_qubits(preparation_backend)
+        if isinstance(backend, StatevectorBackend):
+            # Noiseless preparation: the server's state vector can be prepared in place
+            backend.add_nodes(nodes=self._sorted_nodes, data=run.states)
+            self.blind_qubits(backend)
+        else:
+            # StateVectorBackend because noiseless preparation
+            preparation_backend = StatevectorBackend()
+            preparation_backend.add_nodes(nodes=self._sorted_nodes, data=run.states)
+            self.blind_qubits(preparation_backend)
 
-        backend.add_nodes(nodes=sorted(self.graph[0]), data=preparation_backend.state)
+            backend.add_nodes(nodes=self._sorted_nodes, data=preparation_backend.state)
 
-        tmp_measurement_db = self.measurement_db.copy()
-        # Modify the pattern to be all X-basis measurements, no shifts/signalling updates
+        # Swap in the all X-basis measurements, no shifts/signalling updates
         # Warning should only work for BQP ie classical output
-        for node in self.measurement_db:
-            self.measurement_db[node] = graphix.command.M(node=node)
+        saved_measurement_db, saved_signal_idx = self.measurement_db, self._signal_idx
+        self.measurement_db, self._signal_idx = self._xbasis_measurement_db, self._xbasis_signal_idx
 
         # TODO add measurements on output nodes?
 
-        sim = PatternSimulator(
-            backend=backend, pattern=self.clean_pattern, measure_method=self.measure_method, **kwargs
-        )
-        sim.run(input_state=None)
-
-        trap_outcomes = []
-        for trap in run.traps_list:
-            outcomes = [self.results[component] for component in trap]  # here
-            trap_outcome = sum(outcomes) % 2
-            trap_outcomes.append(trap_outcome)
-
-        self.measurement_db = tmp_measurement_db
+        try:
+            sim = PatternSimulator(
+                backend=backend, pattern=self.clean_pattern, measure_method=self.measure_method, **kwargs
+            )
+            sim.run(input_state=None)
+        finally:
+            self.measurement_db, self._signal_idx = saved_measurement_db, saved_signal_idx
+
+        if run.single_qubit_traps:
+            # The outcome of a single-qubit trap is the outcome of its node
+            trap_outcomes = self.get_results(run.traps_list).tolist()
+        else:
+            trap_outcomes = []
+            for trap in run.traps_list:
+                outcomes = self.get_results(domain_idx(trap_nodes(trap)))
+                trap_outcome = int(np.bitwise_xor.reduce(outcomes, initial=0))
+                trap_outcomes.append(trap_outcome)
 
         return trap_outcomes
 
     def delegate_pattern(self, backend: Backend, **kwargs) -> None:
+        self.reset_results()
         self.prepare_states(backend)
         self.blind_qubits(backend)
         sim = PatternSimulator(
@@ -332,10 +510,14 @@ class Client:
         return secrets_size
 
     def decode_output(self, node):
-        z_decoding = sum(self.results[z_dep] for z_dep in self.byproduct_db[node].z_domain) % 2
-        z_decoding ^= self.secret_datas.r.get(node, 0)
-        x_decoding = sum(self.results[x_dep] for x_dep in self.byproduct_db[node].x_domain) % 2
-        x_decoding ^= self.secret_datas.a.a.get(node, 0)
+        # The domains are short: gather them at once and compute the parities in Python,
+        # starting from the secret to undo
+        idx, z_size = self._zx_idx[node]
+        outcomes = self.results[idx].tolist()
+        if UNMEASURED in outcomes:
+            raise KeyError(int(idx[outcomes.index(UNMEASURED)]))
+        z_decoding = functools.reduce(operator.xor, outcomes[:z_size], self.secret_datas.r.get(node, 0))
+        x_decoding = functools.reduce(operator.xor, outcomes[z_size:], self.secret_datas.a.a.get(node, 0))
         return z_decoding, x_decoding
 
 
@@ -354,9 +536,10 @@ class ClientMeasureMethod(MeasureMethod):
         # print("parameters.", parameters)
         # print("secrets", self.__client.secrets)
         # extract signals for adaptive angle
-        s_signal = sum(self.__client.results[j] for j in parameters.s_domain)
-        t_signal = sum(self.__client.results[j] for j in parameters.t_domain)
-        measure_update = MeasureUpdate.compute(parameters.plane, s_signal % 2 == 1, t_signal % 2 == 1, Clifford.I)
+        s_idx, t_idx = self.__client._signal_idx[cmd.node]
+        s_signal = np.bitwise_xor.reduce(self.__client.get_results(s_idx), initial=0)
+        t_signal = np.bitwise_xor.reduce(self.__client.get_results(t_idx), initial=0)
+        measure_update = MeasureUpdate.compute(parameters.plane, bool(s_signal), bool(t_signal), Clifford.I)
         # print("meas update", measure_update)
         angle = parameters.angle * np.pi
         angle = angle * measure_update.coeff + measure_update.add_term
@@ -1,17 +1,107 @@
 from __future__ import annotations
 
+import functools
 import random
 from typing import TYPE_CHECKING
 
+import networkx as nx
+import numpy as np
 import stim
 from graphix.fundamentals import IXYZ
 from graphix.pauli import Pauli
 
 if TYPE_CHECKING:
-    import networkx as nx
+    import numpy.typing as npt
+    import scipy.sparse
     from graphix.states import State
 
-    Trap = set[int]
+    # A single-qubit trap can be given as a bare node
+    Trap = int | set[int]
+    # Bit-packed Pauli string: row 0 holds the X bits, row 1 the Z bits (I=00, X=10, Z=01, Y=11),
+    # 64 qubits per word, qubit `q` at bit `q % 64` of word `q // 64`.
+    # The qubit of a graph node is its position in the sorted nodes.
+    PackedPauli = npt.NDArray[np.uint64]
+
+WORD_SIZE = 64
+
+
+def pack_paulis(n_qubits: int, x_qubits, z_qubits) -> PackedPauli:
+    """
+    Returns the bit-packed Pauli string on `n_qubits` qubits with X on `x_qubits` and Z on `z_qubits`.
+    Qubits in both sets get a Y.
+    """
+    packed = np.zeros((2, -(-n_qubits // WORD_SIZE)), dtype=np.uint64)
+    for row, qubits in enumerate((x_qubits, z_qubits)):
+        indices = np.fromiter(qubits, dtype=np.intp)
+        bits = np.left_shift(np.uint64(1), (indices % WORD_SIZE).astype(np.uint64))
+        np.bitwise_or.at(packed[row], indices // WORD_SIZE, bits)
+    return packed
+
+
+def unpack_bits(packed: PackedPauli, n_qubits: int) -> npt.NDArray[np.uint8]:
+    """
+    Returns the `(2, n_qubits)` array of X and Z bits of a bit-packed Pauli string.
+    """
+    bytes_le = packed.astype("<u8").view(np.uint8)
+    return np.unpackbits(bytes_le, axis=1, bitorder="little")[:, :n_qubits]
+
+
+def unpack_paulis(packed: PackedPauli, n_qubits: int) -> npt.NDArray[np.uint8]:
+    """
+    Returns the Pauli on each qubit of a bit-packed Pauli string, following the `stim` convention I=0, X=1, Y=2, Z=3.
+    """
+    x, z = unpack_bits(packed, n_qubits)
+    return x ^ (3 * z)
+
+
+@functools.cache
+def pauli_eigenstate(pauli: int, coin: int) -> State:
+    """
+    Returns the eigenstate of the Pauli `pauli` (I=0, X=1, Y=2, Z=3) for the eigenvalue (-1)^coin.
+    There are only 8 of them: they are computed once and shared between all canvases.
+    """
+    return Pauli(IXYZ(pauli)).eigenstate(binary=coin)
+
+
+def trap_nodes(trap: Trap) -> set[int]:
+    return {trap} if isinstance(trap, (int, np.integer)) else trap
+
+
+def build_canonical_stabilizers(nodes, edges) -> dict[int, PackedPauli]:
+    """
+    Returns the canonical stabilizer X_i Z_N(i) of every node `i` of the graph, bit-packed.
+    The qubits follow the order of `nodes`, which should be sorted.
+    The arrays are read-only so that they can be shared between trappified canvases.
+    """
+    node_index = {node: i for i, node in enumerate(nodes)}
+    neighbors = {node: [] for node in nodes}
+    for u, v in edges:
+        neighbors[u].append(node_index[v])
+        neighbors[v].append(node_index[u])
+    stabilizers = {}
+    for node in nodes:
+        stabilizer = pack_paulis(len(nodes), [node_index[node]], neighbors[node])
+        stabilizer.flags.writeable = False
+        stabilizers[node] = stabilizer
+    return stabilizers
+
+
+def merge_compatible(stabilizers: npt.NDArray[np.uint64]) -> PackedPauli:
+    """
+    Merges a stack of bit-packed stabilizers, of shape `(n_stabilizers, 2, n_words)`, into one.
+    Raises `ValueError` if two of them act with different Paulis on a common qubit.
+    """
+    merged = np.bitwise_or.reduce(stabilizers, axis=0)
+    support = stabilizers[:, 0] | stabilizers[:, 1]
+    # The stabilizers are compatible iff each of them coincides with the merge on its support
+    if ((stabilizers ^ merged) & support[:, np.newaxis]).any():
+        raise ValueError("The stabilizers have no common eigenstate and cannot be merged.")
+    return merged
+
+
+def to_pauli_string(packed: PackedPauli, n_qubits: int) -> stim.PauliString:
+    x, z = unpack_bits(packed, n_qubits).astype(bool)
+    return stim.PauliString.from_numpy(xs=x, zs=z)
 
 
 class TrappifiedCanvas:
@@ -29,112 +119,111 @@ class TrappifiedCanvas:
     To one trappified canvas corresponds a list of traps, and a resulting stabilizer expressed in a Pauli string. The input that satisfies all traps is a +1 eigenstate of that operator.
     """
 
-    def __init__(self, graph: nx.Graph, traps_list: set[Trap]) -> None:
+    def __init__(
+        self,
+        graph: nx.Graph,
+        traps_list: list[Trap],
+        canonical_stabilizers: dict[int, PackedPauli] | None = None,
+        adjacency: scipy.sparse.csr_matrix | None = None,
+        presorted: bool = False,
+    ) -> None:
         self.graph = graph
-        self.traps_list = traps_list
-
-        self.trap_stabilizers = [self.compute_trap_stabilizer(trap) for trap in self.traps_list]
-        self.stabilizer = self.merge_pauli_list(self.trap_stabilizers)
+        # The stabilizers and the trap outcomes follow the order of the traps
+        self.traps_list = list(traps_list)
+        self.single_qubit_traps = all(isinstance(trap, (int, np.integer)) for trap in self.traps_list)
+        self.n_qubits = len(self.graph.nodes)
+        # Qubit of each node, i.e. its position in the sorted nodes
+        self.nodes = sorted(self.graph.nodes)
+        self.node_index = {node: i for i, node in enumerate(self.nodes)}
+        # The canonical stabilizers only depend on the graph: they can be shared between canvases
+        if canonical_stabilizers is None:
+            canonical_stabilizers = build_canonical_stabilizers(self.nodes, self.graph.edges)
+        self.canonical_stabilizers = canonical_stabilizers
+        # Adjacency matrix of the graph, with rows and columns ordered by qubit; edge weights are ignored
+        if adjacency is None:
+            adjacency = nx.to_scipy_sparse_array(self.graph, nodelist=self.nodes, dtype=np.uint8, weight=None)
+        self.adjacency = adjacency
+
+        self.trap_stabilizers = np.stack([self.compute_trap_stabilizer(trap) for trap in self.traps_list])
+        if presorted:
+            # The traps are known to be pairwise compatible (e.g. single-qubit traps of the same color),
+            # so they can all be merged in a single pass
+            self.stabilizer = merge_compatible(self.trap_stabilizers)
+        else:
+            self.stabilizer = self.merge_pauli_list(self.trap_stabilizers)
         dummies_coins = self.generate_coins_dummies()
         self.coins = self.generate_coins_trap_qubits(coins=dummies_coins)
         self.states = self.generate_eigenstate()
 
-    def common_eigenstate(self, stabilizer_1: stim.PauliString, stabilizer_2: stim.PauliString) -> bool:
+    def common_eigenstate(self, stabilizer_1: PackedPauli, stabilizer_2: PackedPauli) -> bool:
         """
-        Returns `True` if the two stabilizers have a common eigenstate
+        Returns `True` if the two stabilizers have a common eigenstate,
+        i.e. they carry the same Pauli on every qubit where both act non-trivially.
         """
-        for axis in ["X", "Y", "Z"]:
-            if not set(stabilizer_1.pauli_indices(axis)).issubset(set(stabilizer_2.pauli_indices("I" + axis))):
-                return False
-        return True
-
-    def merge(self, stabilizer_1: stim.PauliString, stabilizer_2: stim.PauliString) -> stim.PauliString:
-        result = stabilizer_2.sign * stabilizer_1
-        # We can iterate through the support of stab2 as they are supposed to have equal support
-        for node in stabilizer_2.pauli_indices("XYZ"):
-            result[node] = stabilizer_2[node]
-        return result
-
-    def get_canonical_stabilizer(self, node) -> stim.PauliString:
-        chain = stim.PauliString(len(self.graph.nodes))
-
-        chain[node] = "X"
-        for n in self.graph.neighbors(node):
-            chain[n] = "Z"
-        return chain
-
-    def compute_trap_stabilizer(self, trap: set[int]) -> stim.PauliString:
-        trap_stabilizer = stim.PauliString(len(self.graph.nodes))
-        for node in trap:
-            trap_stabilizer *= self.get_canonical_stabilizer(node)
-        return trap_stabilizer
-
-    def merge_pauli_list(self, pauli_list) -> stim.PauliString:
-        """
-        If the protocol is coherent, all the stabilizers should be able to merge in one Pauli string.
-        """
-        # Initial flag to track if any merging happens in the iteration
-        merged = True
-
-        while merged:
-            merged = False
-            i = 0
-
-            while i < len(pauli_list) - 1:
-                j = i + 1
+        common_support = (stabilizer_1[0] | stabilizer_1[1]) & (stabilizer_2[0] | stabilizer_2[1])
+        mismatch = (stabilizer_1[0] ^ stabilizer_2[0]) | (stabilizer_1[1] ^ stabilizer_2[1])
+        return not (common_support & mismatch).any()
 
-                while j < len(pauli_list):
-                    if self.common_eigenstate(pauli_list[i], pauli_list[j]):
-                        # Merge the two PauliStrings
-                        merged_pauli = self.merge(pauli_list[i], pauli_list[j])
+    def merge(self, stabilizer_1: PackedPauli, stabilizer_2: PackedPauli) -> PackedPauli:
+        # The stabilizers agree on their common support, so the merge is the union of both
+        return stabilizer_1 | stabilizer_2
 
-                        # Replace the first element with the merged result
-                        pauli_list[i] = merged_pauli
+    def get_canonical_stabilizer(self, node) -> PackedPauli:
+        return self.canonical_stabilizers[node]
 
-                        # Remove the second element
-                        del pauli_list[j]
+    def compute_trap_stabilizer(self, trap: Trap) -> PackedPauli:
+        if isinstance(trap, (int, np.integer)):
+            return self.get_canonical_stabilizer(trap)
+        # Product of the canonical stabilizers, up to a phase
+        return functools.reduce(np.bitwise_xor, (self.get_canonical_stabilizer(node) for node in trap))
 
-                        # Set merged flag to True to indicate a merge happened
-                        merged = True
-
-                        # Break the inner loop since we need to recheck the new list
-                        break
-                    else:
-                        j += 1
-
-                if not merged:
-                    i += 1
+    def merge_pauli_list(self, pauli_list) -> PackedPauli:
+        """
+        If the protocol is coherent, all the stabilizers should be able to merge in one Pauli string.
 
-        return pauli_list[0]
+        Each stabilizer is merged into the first compatible merged group, or starts a new group;
+        the first group is returned.
+        """
+        merged_list = []
+        for pauli in pauli_list:
+            for i, merged_pauli in enumerate(merged_list):
+                if self.common_eigenstate(merged_pauli, pauli):
+                    merged_list[i] = self.merge(merged_pauli, pauli)
+                    break
+            else:
+                merged_list.append(pauli)
+        return merged_list[0]
 
     @property
     def trap_qubits(self):
-        return [node for trap in self.traps_list for node in trap]
+        if self.single_qubit_traps:
+            return list(self.traps_list)
+        return [node for trap in self.traps_list for node in trap_nodes(trap)]
 
     @property
     def dummy_qubits(self):
-        return [neighbor for trap in self.traps_list for node in trap for neighbor in list(self.graph.neighbors(node))]
+        return [neighbor for node in self.trap_qubits for neighbor in list(self.graph.neighbors(node))]
 
     def generate_eigenstate(self) -> list[State]:
-        states = []
-        for node in sorted(self.graph.nodes):
-            operator = Pauli(IXYZ(self.stabilizer[node]))
-            states.append(operator.eigenstate(binary=self.coins[node]))
-        return states
-
-    def generate_coins_dummies(self):
-        coins = dict()
-        for node in self.graph.nodes:
-            if node not in self.trap_qubits:
-                coins[node] = random.randint(0, 1)
-            else:
-                coins[node] = 0
+        paulis = unpack_paulis(self.stabilizer, self.n_qubits).tolist()
+        coins = self.coins.tolist()
+        return [pauli_eigenstate(paulis[i], coins[i]) for i in range(self.n_qubits)]
+
+    def generate_coins_dummies(self) -> npt.NDArray[np.uint8]:
+        """
+        Returns the coins of the canvas, indexed by qubit: random for the dummies, 0 for the trap qubits.
+        """
+        trap_qubits = set(self.trap_qubits)
+        dummies = [self.node_index[node] for node in self.graph.nodes if node not in trap_qubits]
+        coins = np.zeros(self.n_qubits, dtype=np.uint8)
+        coins[dummies] = [random.randint(0, 1) for _ in dummies]
         return coins
 
-    def generate_coins_trap_qubits(self, coins):
-        for node in self.trap_qubits:
-            coins[node] = sum(coins[n] for n in self.graph.neighbors(node)) % 2
+    def generate_coins_trap_qubits(self, coins: npt.NDArray[np.uint8]) -> npt.NDArray[np.uint8]:
+        # The coin of a trap qubit is the parity of the coins of its neighbors
+        trap_qubits = [self.node_index[node] for node in self.trap_qubits]
+        coins[trap_qubits] = (self.adjacency @ coins)[trap_qubits] & 1
         return coins
 
     def __str__(self) -> str:
-        return f"List of traps: {self.traps_list}\nStabilizer: {self.stabilizer}"
+        return f"List of traps: {self.traps_list}\nStabilizer: {to_pauli_string(self.stabilizer, self.n_qubits)}"